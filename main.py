@@ -1,31 +1,214 @@
 import os
-from fastapi import FastAPI
-from pydantic import BaseModel
+import asyncio
+import atexit
+from fastapi import BackgroundTasks, FastAPI
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional
 import re
+import json
+import hashlib
 import logging
-from huggingface_hub import InferenceClient
+import logging.handlers
+import queue
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager
+import httpx
+from huggingface_hub import AsyncInferenceClient
 
-# Configure logging with increased max message length
+# Configure logging with increased max message length. Records are handed to a
+# queue and written by a listener thread, so request handlers never block on stderr.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message).1000s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message).1000s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+# Started here rather than in lifespan so logging works without it (e.g. --lifespan off)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flushes any queued records
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
 HF_TOKEN = os.getenv("HF_TOKEN", "")
-MODEL_NAME = "deepseek-ai/DeepSeek-R1-0528-Qwen3-8B"
+# A non-reasoning instruct model: reasoning models think before answering and
+# would spend the whole capped token budget before emitting the tag
+MODEL_NAME = os.getenv("HF_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
+# Optional OpenAI-compatible server to use instead of HF serverless inference, e.g. a
+# self-hosted `vllm serve <MODEL_NAME> --enable-prefix-caching` or TGI at http://vllm:8000
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "")
+
+# Created once at startup and reused so the HTTP connection pool stays warm
+_HF_CLIENT: Optional[AsyncInferenceClient] = None
+
+# ISPs queued within LLM_BATCH_WINDOW are classified together in one LLM call
+LLM_BATCH_WINDOW = float(os.getenv("LLM_BATCH_WINDOW_MS", "20")) / 1000  # seconds
+LLM_MAX_BATCH = int(os.getenv("LLM_MAX_BATCH", "16"))
+_LLM_QUEUE: "Optional[asyncio.Queue[tuple[str, asyncio.Future]]]" = None
+_LLM_BATCHES: "set[asyncio.Task]" = set()
+# Upper bound on LLM calls in flight, so bursts queue here instead of drawing 429s upstream
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+_LLM_SEMAPHORE = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# After an LLM error, skip the LLM for this long instead of retrying on every request;
+# after LLM_BREAKER_THRESHOLD consecutive errors, stay off it for LLM_BREAKER_COOLDOWN
+LLM_FAILURE_BACKOFF = float(os.getenv("LLM_FAILURE_BACKOFF", "5"))  # seconds
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # seconds
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "10"))  # seconds per whole call; overruns count as errors
+# Longest a request waits for its classification, including time queued for a slot
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", str(2 * LLM_TIMEOUT)))  # seconds
+_FAILURE_UNTIL = 0.0
+_CONSECUTIVE_FAILURES = 0
+
+# Hosts allowed as `callback_url` targets; callbacks are off while this is empty
+CALLBACK_ALLOWED_HOSTS = frozenset(
+    host.strip().lower() for host in os.getenv("CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()
+)
+_CALLBACK_CLIENT: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _HF_CLIENT, _LLM_QUEUE, _CALLBACK_CLIENT
+    dispatcher = None
+    _load_isp_cache()
+    if HF_TOKEN or LLM_BASE_URL:
+        _HF_CLIENT = AsyncInferenceClient(
+            base_url=LLM_BASE_URL or None, token=HF_TOKEN or None, timeout=LLM_TIMEOUT
+        )
+        _LLM_QUEUE = asyncio.Queue()
+        dispatcher = asyncio.create_task(_dispatch_llm_batches())
+        # Changes here invalidate the provider's prefix cache, so make drift visible
+        logger.info(
+            "System prompt sha256: %s",
+            hashlib.sha256(_SYSTEM_MSG["content"].encode()).hexdigest()
+        )
+    if CALLBACK_ALLOWED_HOSTS:
+        _CALLBACK_CLIENT = httpx.AsyncClient(timeout=LLM_TIMEOUT)
+    yield
+    if _CALLBACK_CLIENT is not None:
+        await _CALLBACK_CLIENT.aclose()
+        _CALLBACK_CLIENT = None
+    # Cleared first so lookups arriving during shutdown take the no-client fallback
+    client, _HF_CLIENT = _HF_CLIENT, None
+    if dispatcher is not None:
+        batches = [dispatcher, *_LLM_BATCHES]
+        for task in batches:
+            task.cancel()
+        await asyncio.gather(*batches, return_exceptions=True)
+        while not _LLM_QUEUE.empty():
+            _resolve_unanswered([_LLM_QUEUE.get_nowait()])
+        _LLM_QUEUE = None
+    if client is not None:
+        await client.close()
+    _save_isp_cache()
+
+app = FastAPI(lifespan=lifespan)
+
+# ISP classification cache: normalized ISP -> (expires_at, (classification, reasoning))
+ISP_CACHE_MAXSIZE = int(os.getenv("ISP_CACHE_MAXSIZE", "50000"))
+ISP_CACHE_TTL = int(os.getenv("ISP_CACHE_TTL", str(24 * 3600)))  # seconds
+_ISP_CACHE: "OrderedDict[str, tuple[float, tuple[str, str]]]" = OrderedDict()
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# The key is also the prompt text, and batched prompts mix ISPs from unrelated
+# requests: drop the tag brackets and list numbering a caller could use to answer
+# for its neighbours, and cap the length sent upstream and kept as a key
+_PROMPT_MARKUP_RE = re.compile(r"[\[\]]|\b\d+[.)](?!\S)")
+ISP_KEY_MAX_LENGTH = 100
+
+def _isp_cache_key(isp: str) -> str:
+    """Normalize case and whitespace so spelling variants share one entry"""
+    isp = _PROMPT_MARKUP_RE.sub(" ", isp[:4 * ISP_KEY_MAX_LENGTH].lower())
+    return _WHITESPACE_RE.sub(" ", isp).strip()[:ISP_KEY_MAX_LENGTH].rstrip()
+
+def _cache_get(key: str) -> Optional[tuple[str, str]]:
+    """Return a cached classification, dropping it if expired"""
+    entry = _ISP_CACHE.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        del _ISP_CACHE[key]
+        return None
+    _ISP_CACHE.move_to_end(key)
+    return value
+
+def _cache_put(key: str, value: tuple[str, str]) -> None:
+    """Store a classification, evicting the least recently used entry when full"""
+    _ISP_CACHE[key] = (time.monotonic() + ISP_CACHE_TTL, value)
+    _ISP_CACHE.move_to_end(key)
+    if len(_ISP_CACHE) > ISP_CACHE_MAXSIZE:
+        _ISP_CACHE.popitem(last=False)
+
+# Optional JSON snapshot of the cache so restarts don't re-pay the LLM for known ISPs
+ISP_CACHE_FILE = os.getenv("ISP_CACHE_FILE", "")
+
+def _read_isp_cache_file() -> "dict[str, tuple[float, str, str]]":
+    """Return unexpired ISP_CACHE_FILE rows as key -> (expires_wall, classification, reasoning)"""
+    if not os.path.exists(ISP_CACHE_FILE):
+        return {}
+    try:
+        with open(ISP_CACHE_FILE, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not load ISP cache from %s: %s", ISP_CACHE_FILE, e)
+        return {}
+    now_wall = time.time()
+    rows = {}
+    try:
+        for key, expires_wall, classification, reasoning in entries:
+            if expires_wall > now_wall:
+                rows[key] = (expires_wall, classification, reasoning)
+    except (TypeError, ValueError) as e:
+        # Valid JSON but not the list of rows _save_isp_cache writes
+        logger.warning("Ignoring malformed ISP cache %s: %s", ISP_CACHE_FILE, e)
+        return {}
+    return rows
+
+def _load_isp_cache() -> None:
+    """Restore unexpired entries from ISP_CACHE_FILE, if one exists"""
+    if not ISP_CACHE_FILE:
+        return
+    rows = list(_read_isp_cache_file().items())[-ISP_CACHE_MAXSIZE:]
+    # Expiry is stored as wall-clock time since monotonic clocks reset across processes
+    now_wall, now_mono = time.time(), time.monotonic()
+    for key, (expires_wall, classification, reasoning) in rows:
+        _ISP_CACHE[key] = (now_mono + expires_wall - now_wall, (classification, reasoning))
+    logger.info("Loaded %d cached ISP classifications", len(_ISP_CACHE))
+
+def _save_isp_cache() -> None:
+    """Merge unexpired entries into ISP_CACHE_FILE, least recently used first"""
+    if not ISP_CACHE_FILE:
+        return
+    # Other workers (WEB_CONCURRENCY > 1) share the file, so keep the rows they
+    # saved; two workers exiting at the same instant can still drop one's rows
+    rows = _read_isp_cache_file()
+    now_wall, now_mono = time.time(), time.monotonic()
+    for key, (expires_at, (classification, reasoning)) in _ISP_CACHE.items():
+        if expires_at > now_mono:
+            rows.pop(key, None)  # Re-added last, as this worker's view is the newest
+            rows[key] = (now_wall + expires_at - now_mono, classification, reasoning)
+    entries = [[key, *row] for key, row in list(rows.items())[-ISP_CACHE_MAXSIZE:]]
+    tmp_path = f"{ISP_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, ISP_CACHE_FILE)
+    except OSError as e:
+        logger.warning("Could not save ISP cache to %s: %s", ISP_CACHE_FILE, e)
 
 class AICheckRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     ua: Optional[str] = ""
     supportsCookies: Optional[bool] = None
     jsEnabled: Optional[bool] = None
     screenRes: Optional[str] = ""
     lang: Optional[str] = ""
     timezone: Optional[str] = ""
-    headers: Optional[dict] = {}
+    headers: Optional[dict] = Field(default_factory=dict)
     fingerprint: Optional[dict] = None
     isp: Optional[str] = ""
     isBotUserAgent: Optional[bool] = False
@@ -34,164 +217,447 @@ class AICheckRequest(BaseModel):
     isSuspiciousTraffic: Optional[bool] = False
     isDataCenterASN: Optional[bool] = False
     honeypotVisited: Optional[bool] = False  # <--- Added this line
+    callback_url: Optional[str] = None  # Receives the final verdict when ISP research is deferred
+
+class HealthResponse(BaseModel):
+    status: str
+    model: str
+
+class DecisionReason(BaseModel):
+    summary: str
+    details: str
+    decision_tag: str
+
+class DecisionFlags(BaseModel):
+    isBot: Optional[bool] = False
+    isScraper: Optional[bool] = False
+    isDC: Optional[bool] = False
+
+class DecisionDetails(BaseModel):
+    ua: str = ""
+    isp: Optional[str] = ""
+    flags: DecisionFlags
+
+class DecisionResponse(BaseModel):
+    verdict: str
+    reason: DecisionReason
+    details: DecisionDetails
+
+# Well-known networks classified locally so they never reach the LLM
+SAFE_ISPS = (
+    # North America
+    "comcast", "xfinity", "charter communications", "spectrum", "cox communications",
+    "verizon", "at&t", "centurylink", "frontier communications",
+    "windstream", "mediacom", "optimum", "altice", "t-mobile", "sprint",
+    "us cellular", "rogers", "fido", "bell canada", "bell mobility", "eastlink",
+    "telus", "videotron", "cogeco", "shaw communications", "freedom mobile",
+    "telmex", "telcel",
+    # Europe
+    "bt", "british telecommunications", "virgin media", "sky broadband",
+    "talktalk", "orange", "free sas", "free mobile", "sfr", "bouygues telecom",
+    "deutsche telekom",
+    "vodafone", "telefonica", "movistar", "telecom italia", "swisscom",
+    "proximus", "kpn", "ziggo", "telia", "telenor",
+    # Asia-Pacific, Latin America, Africa
+    "telstra", "bigpond", "optus", "tpg", "spark new zealand", "ntt docomo",
+    "kddi", "softbank", "reliance jio", "bharti airtel", "airtel", "bsnl",
+    "claro", "mtn", "safaricom", "vodacom",
+)
+UNSAFE_ISPS = (
+    # Cloud and CDN
+    "amazon", "aws", "microsoft", "azure", "linkedin", "github",
+    "google cloud", "gcp", "google llc",
+    "oracle cloud", "ibm cloud", "softlayer", "alibaba", "tencent cloud",
+    "huawei cloud", "digitalocean", "linode", "akamai", "cloudflare", "fastly",
+    "cdn77", "zenlayer", "g-core", "gcore",
+    # Hosting and colocation
+    "vultr", "choopa", "ovh", "hetzner", "leaseweb", "contabo", "scaleway",
+    "rackspace", "godaddy", "hostinger", "bluehost", "dreamhost", "namecheap",
+    "m247", "datacamp", "quadranet", "psychz", "colocrossing",
+    "hurricane electric", "spacex services",
+    # Proxy, VPN and scraping networks
+    "brightdata", "bright data", "luminati", "oxylabs", "smartproxy", "netnut",
+    "iproyal", "nordvpn", "expressvpn", "surfshark", "mullvad", "cyberghost",
+    "private internet access", "ipvanish",
+    # Security vendors
+    "fortinet", "zscaler", "palo alto networks", "proofpoint", "mimecast",
+    "netskope", "forcepoint", "barracuda",
+    # Generic markers
+    "datacenter", "data center", "hosting", "vps",
+)
+
+def _compile_isp_pattern(names: tuple[str, ...]) -> re.Pattern:
+    return re.compile(r"\b(?:" + "|".join(map(re.escape, names)) + r")\b", re.IGNORECASE)
 
-@app.get("/")
+_SAFE_ISP_RE = _compile_isp_pattern(SAFE_ISPS)
+_UNSAFE_ISP_RE = _compile_isp_pattern(UNSAFE_ISPS)
+
+# Browser integrity checks
+_BOT_INDICATORS_RE = re.compile(
+    r"bot|curl|python|wget|scrapy|headless|phantom|selenium|spider|zgrab|nmap|masscan",
+    re.IGNORECASE
+)
+_BAD_RES = frozenset({"0x0", "1x1"})
+
+_TAG_RE = re.compile(r"\[(safe|unsafe|verification)\]", re.IGNORECASE)
+# "<n>. [tag] <analysis>" lines of a batched reply
+_BATCH_LINE_RE = re.compile(r"^\s*(\d+)[.)]\s*(.+)$", re.MULTILINE)
+
+# Kept byte-identical across calls so backends with prefix caching skip its prefill
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": """Classify each ISP. Answer one line per ISP: a tag, then a few words why.
+[safe] major residential ISP or mobile carrier (e.g. Comcast, BT, Rogers, Telstra, T-Mobile)
+[unsafe] cloud, datacenter, hosting, Microsoft, SpaceX, security, VPN, proxy or scraper network
+[verification] only if the ISP is truly unknown
+Use exactly one tag.
+Example: "[unsafe] Microsoft Azure cloud service"
+"""
+}
+
+@app.get("/", response_model=HealthResponse)
 async def health():
     return {"status": "ok", "model": MODEL_NAME}
 
-def research_isp_with_llm(isp: str) -> tuple[str, str]:
+def classify_isp_locally(isp: str) -> Optional[tuple[str, str]]:
+    """
+    Classify well-known ISPs without the LLM
+    Returns (classification, reasoning), or None if the ISP is not recognised
+    """
+    if not isp:
+        return None
+    match = _UNSAFE_ISP_RE.search(isp)
+    if match:
+        return "unsafe", f"Known cloud/datacenter/security network '{match.group(0)}' [unsafe]"
+    match = _SAFE_ISP_RE.search(isp)
+    if match:
+        return "safe", f"Known residential/mobile ISP '{match.group(0)}' [safe]"
+    return None
+
+# In-flight LLM classifications, so concurrent requests for one ISP share a single call
+_INFLIGHT: "dict[str, asyncio.Task[tuple[str, str]]]" = {}
+
+async def research_isp_with_llm(cache_key: str) -> tuple[str, str]:
     """
     Classify ISP with strict rules and consistent responses
+    Takes the ISP as normalized by _isp_cache_key()
     Returns (classification, full_reasoning)
     """
-    if not isp or not HF_TOKEN:
+    if not cache_key or _HF_CLIENT is None:
         return "verification", "No ISP provided [verification]"
 
-    messages = [
-        {
-            "role": "system",
-            "content": """[STRICT CLASSIFICATION RULES]
-You are a network classification expert. Analyze the ISP and respond with:
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+    if time.monotonic() < _FAILURE_UNTIL:
+        return _DEGRADED_RESULT
 
-1. A concise analysis (1-2 sentences)
-2. Exactly one classification tag at the end: [safe], [unsafe], or [verification]
+    task = _INFLIGHT.get(cache_key)
+    if task is None:
+        # The normalized name doubles as the prompt text
+        task = asyncio.create_task(_classify_isp_with_llm(cache_key))
+        _INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(cache_key, None))
+    # Shielded so one cancelled caller doesn't abort the call for the others
+    return await asyncio.shield(task)
 
-RULES:
-- [safe]: Use ONLY for major, well-known residential ISPs and mobile carriers (e.g., Comcast, BT, Eastlink, Rogers, AT&T, Telstra, Orange, T-Mobile, etc). If you are confident the ISP is primarily residential, use [safe]. Do NOT use [verification] for these.
-- [unsafe]: Use for any ISP clearly identified as a cloud provider, datacenter, Microsoft,spacex services inc, security/VPN/scraper, or not residential.
-- [verification]: Use ONLY if there is NO info about the ISP or if it's impossible to determine its type after a good-faith search. Never use [verification] for well-known residential ISPs.
+async def _classify_isp_with_llm(isp: str) -> tuple[str, str]:
+    """Queue the ISP for the next LLM batch and wait for its classification"""
+    if _LLM_QUEUE is None:
+        return _SHUTDOWN_RESULT
+    future = asyncio.get_running_loop().create_future()
+    await _LLM_QUEUE.put((isp, future))
+    try:
+        return await asyncio.wait_for(future, LLM_MAX_WAIT)
+    except asyncio.TimeoutError:
+        # Cancels the future, so its batch skips the call if nobody else is waiting
+        return _DEGRADED_RESULT
 
-NEVER use multiple tags. Always commit to a single, best tag.
+_DEGRADED_RESULT = ("verification", "Classification skipped: upstream degraded [verification]")
+_SHUTDOWN_RESULT = ("verification", "Classification skipped: shutting down [verification]")
 
-Example: "This is a Microsoft Azure cloud service [unsafe]"
-"""
-        },
-        {
-            "role": "user",
-            "content": f"Classify this ISP with full reasoning: {isp}"
-        }
-    ]
+def _resolve_unanswered(
+    batch: list[tuple[str, asyncio.Future]], result: tuple[str, str] = _SHUTDOWN_RESULT
+) -> None:
+    """Give waiters the fallback instead of leaving them hanging"""
+    for _, future in batch:
+        if not future.done():
+            future.set_result(result)
 
+async def _dispatch_llm_batches() -> None:
+    """Collect queued ISPs for up to LLM_BATCH_WINDOW and classify them together"""
+    loop = asyncio.get_running_loop()
+    batch = []
     try:
-        client = InferenceClient(token=HF_TOKEN)
-        response = client.chat_completion(
-            messages=messages,
-            model=MODEL_NAME,
-            max_tokens=300,  # Increased to allow full response
-            temperature=0.1
-        )
-        
-        full_response = response.choices[0].message.content
-        
-        # Log the complete response in chunks if needed
-        max_log_length = 1000  # Adjust based on your logging system
-        if len(full_response) > max_log_length:
-            for i in range(0, len(full_response), max_log_length):
-                logger.info(f"AI Response Part {i//max_log_length + 1}: {full_response[i:i+max_log_length]}")
-        else:
-            logger.info(f"Full AI classification response: {full_response}")
-        
-        # Extract the last valid tag from response
-        tags = re.findall(r"\[(safe|unsafe|verification)\]", full_response.lower())
-        classification = tags[-1] if tags else "verification"
-            
-        return classification, full_response
+        while True:
+            batch = [await _LLM_QUEUE.get()]
+            deadline = loop.time() + LLM_BATCH_WINDOW
+            while len(batch) < LLM_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_LLM_QUEUE.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(_run_llm_batch(batch))
+            _LLM_BATCHES.add(task)
+            task.add_done_callback(_LLM_BATCHES.discard)
+            batch = []
+    except asyncio.CancelledError:
+        _resolve_unanswered(batch)
+        raise
 
+async def _run_llm_batch(batch: list[tuple[str, asyncio.Future]]) -> None:
+    """Classify a batch of ISPs, cache successful results and resolve their futures"""
+    global _FAILURE_UNTIL, _CONSECUTIVE_FAILURES
+    isps = [isp for isp, _ in batch]
+    error_msg = "Classification error: no tag returned for this ISP"
+    try:
+        async with _LLM_SEMAPHORE:
+            if all(future.done() for _, future in batch):
+                return  # Every waiter gave up while the batch queued for a slot
+            if time.monotonic() < _FAILURE_UNTIL:
+                # Tripped while this batch queued for a slot; don't call the failing provider
+                _resolve_unanswered(batch, _DEGRADED_RESULT)
+                return
+            # The client timeout applies per read, so a trickling reply could hold a slot
+            # indefinitely; this bounds the whole call once a slot is acquired
+            if len(isps) == 1:
+                results = [await asyncio.wait_for(_llm_classify_one(isps[0]), LLM_TIMEOUT)]
+            else:
+                results = await asyncio.wait_for(_llm_classify_many(isps), LLM_TIMEOUT)
+    except asyncio.CancelledError:
+        _resolve_unanswered(batch)
+        raise
     except Exception as e:
-        error_msg = f"Classification error: {str(e)}"
+        error_msg = f"Classification error: {str(e) or type(e).__name__}"
         logger.error(error_msg)
-        return "verification", f"{error_msg} [verification]"
+        _CONSECUTIVE_FAILURES += 1
+        if _CONSECUTIVE_FAILURES >= LLM_BREAKER_THRESHOLD:
+            logger.warning("LLM circuit open for %.0fs after %d consecutive errors",
+                           LLM_BREAKER_COOLDOWN, _CONSECUTIVE_FAILURES)
+            _FAILURE_UNTIL = time.monotonic() + LLM_BREAKER_COOLDOWN
+        else:
+            _FAILURE_UNTIL = time.monotonic() + LLM_FAILURE_BACKOFF
+        results = [None] * len(isps)
+    else:
+        _CONSECUTIVE_FAILURES = 0
 
-def format_decision(verdict: str, details: dict, isp_reason: str = "") -> dict:
-    """Generate complete decision response with structured reasoning"""
-    base_reasons = {
-        "bot": {
-            "summary": "Automation detected",
-            "details": isp_reason if isp_reason else (
-                "Cloud provider detected" if details.get('isDataCenterASN') else
-                "Bot user agent detected" if details.get('isBotUserAgent') else
-                "Multiple abuse flags triggered"
-            )
-        },
-        "captcha": {
-            "summary": "Verification required",
-            "details": isp_reason if isp_reason and verdict == "captcha" else (
-                "JS/Cookies disabled" if not details.get('jsEnabled') or not details.get('supportsCookies') else
-                "Suspicious screen resolution" if details.get('screenRes') in {"0x0", "1x1"} else
-                "Unusual browser characteristics detected"
-            )
-        },
-        "user": {
-            "summary": "Authentic user",
-            "details": "Residential network verified" if "comcast" in (details.get('isp') or "").lower() else
-                      "All security checks passed"
-        }
-    }
+    for (isp, future), result in zip(batch, results):
+        if result is None:
+            result = ("verification", f"{error_msg} [verification]")
+        else:
+            _cache_put(isp, result)
+        if not future.done():
+            future.set_result(result)
+
+def _llm_messages(user_content: str) -> list[dict]:
+    # Only the short user turn varies, so providers can reuse the cached system prefix
+    return [_SYSTEM_MSG, {"role": "user", "content": user_content}]
+
+def _log_llm_reply(full_response: str) -> None:
+    """Log the reply text in chunks if needed"""
+    if not logger.isEnabledFor(logging.INFO):
+        return  # Skip slicing the reply when it would be filtered anyway
+    max_log_length = 1000  # Adjust based on your logging system
+    if len(full_response) > max_log_length:
+        for i in range(0, len(full_response), max_log_length):
+            logger.info("AI Response Part %d: %s", i//max_log_length + 1, full_response[i:i+max_log_length])
+    else:
+        logger.info("Full AI classification response: %s", full_response)
+
+def _extract_tag(text: str) -> Optional[str]:
+    """Return the leading classification tag in text"""
+    match = _TAG_RE.search(text)
+    return match.group(1).lower() if match else None
+
+async def _llm_classify_one(isp: str) -> Optional[tuple[str, str]]:
+    """Classify a single ISP; None when the reply carries no tag"""
+    response = await _HF_CLIENT.chat_completion(
+        messages=_llm_messages(f"Classify this ISP: {isp}"),
+        model=MODEL_NAME,
+        max_tokens=16,  # The tag plus a few words of reasoning
+        stop=["\n"],  # One line is the whole answer
+        temperature=0.0
+    )
     
-    reason = base_reasons.get(verdict, {
-        "summary": "Unknown status",
-        "details": "Needs manual review"
-    })
+    # Only the first line, even if the provider ignores `stop`
+    full_response = (response.choices[0].message.content or "").split("\n", 1)[0].rstrip()
+    _log_llm_reply(full_response)
     
+    tag = _extract_tag(full_response)
+    return (tag, full_response) if tag else None
+
+async def _llm_classify_many(isps: list[str]) -> list[Optional[tuple[str, str]]]:
+    """Classify several ISPs with one numbered prompt; None where no tag came back"""
+    numbered = "\n".join(f"{i}. {isp}" for i, isp in enumerate(isps, 1))
+    response = await _HF_CLIENT.chat_completion(
+        messages=_llm_messages(
+            "Classify each ISP below. Answer with one line per ISP, in the same order, "
+            f"formatted as '<number>. [tag] <analysis>':\n{numbered}"
+        ),
+        model=MODEL_NAME,
+        max_tokens=16 * len(isps),
+        temperature=0.0
+    )
+    
+    full_response = (response.choices[0].message.content or "").rstrip()
+    _log_llm_reply(full_response)
+    lines = {int(m.group(1)): m.group(2).strip() for m in _BATCH_LINE_RE.finditer(full_response)}
+    results = []
+    for i in range(1, len(isps) + 1):
+        line = lines.get(i, "")
+        tag = _extract_tag(line)
+        results.append((tag, line) if tag else None)
+    return results
+
+# Static parts of each verdict's response
+_REASON_SUMMARIES = {
+    "bot": "Automation detected",
+    "captcha": "Verification required",
+    "user": "Authentic user",
+    "pending_isp": "ISP verification pending",
+}
+_DECISION_TAGS = {verdict: f"[{verdict}]" for verdict in _REASON_SUMMARIES}
+
+def _default_reason_details(verdict: str, data: AICheckRequest) -> str:
+    """Explain the verdict from the request flags when there is no ISP reasoning"""
+    if verdict == "bot":
+        return (
+            "Cloud provider detected" if data.isDataCenterASN else
+            "Bot user agent detected" if data.isBotUserAgent else
+            "Multiple abuse flags triggered"
+        )
+    if verdict == "captcha":
+        return (
+            "JS/Cookies disabled" if not data.jsEnabled or not data.supportsCookies else
+            "Suspicious screen resolution" if data.screenRes in _BAD_RES else
+            "Unusual browser characteristics detected"
+        )
+    if verdict == "user":
+        return ("Residential network verified" if "comcast" in (data.isp or "").lower() else
+                "All security checks passed")
+    if verdict == "pending_isp":
+        return "Final verdict will be posted to callback_url"
+    return "Needs manual review"
+
+def format_decision(verdict: str, data: AICheckRequest, isp_reason: str = "") -> dict:
+    """Generate complete decision response with structured reasoning"""
+    logger.info("Decision %s for ISP %.50s", verdict, data.isp or "")
     return {
         "verdict": verdict,
         "reason": {
-            "summary": reason['summary'],
-            "details": isp_reason if isp_reason and verdict != "captcha" else reason['details'],
-            "decision_tag": f"[{verdict}]"
+            "summary": _REASON_SUMMARIES.get(verdict, "Unknown status"),
+            "details": isp_reason or _default_reason_details(verdict, data),
+            "decision_tag": _DECISION_TAGS.get(verdict) or f"[{verdict}]"
         },
         "details": {
-            "ua": details.get('ua', '')[:100],
-            "isp": details.get('isp', ''),
+            "ua": (data.ua or "")[:100],
+            "isp": data.isp,
             "flags": {
-                "isBot": details.get('isBotUserAgent', False),
-                "isScraper": details.get('isScraperISP', False),
-                "isDC": details.get('isDataCenterASN', False)
+                "isBot": data.isBotUserAgent,
+                "isScraper": data.isScraperISP,
+                "isDC": data.isDataCenterASN
             }
         }
     }
 
-@app.post("/ai-decision")
-async def ai_decision(data: AICheckRequest):
-    details = data.dict()
-    logger.info(f"Request received - UA: {details.get('ua','')[:50]}...")
+def _decide_with_isp(data: AICheckRequest, isp_result: Optional[tuple[str, str]],
+                     suspicious_browser: bool) -> dict:
+    """Final verdict once the ISP classification (if any) is known"""
+    if isp_result is not None:
+        isp_classification, isp_reason = isp_result
+        if isp_classification == "unsafe":
+            return format_decision("bot", data, isp_reason)
+        elif isp_classification == "verification":
+            return format_decision("captcha", data, isp_reason)
+    
+    if suspicious_browser:
+        return format_decision("captcha", data)
+    
+    # 4. Verified safe user
+    return format_decision("user", data)
+
+def _callback_allowed(url: Optional[str]) -> bool:
+    if not url or _CALLBACK_CLIENT is None:
+        return False
+    try:
+        parts = urlsplit(url)
+        hostname = parts.hostname or ""
+    except ValueError:
+        return False
+    return parts.scheme in ("http", "https") and hostname in CALLBACK_ALLOWED_HOSTS
+
+async def _resolve_isp_and_post(data: AICheckRequest, isp_key: str) -> None:
+    """Research the ISP off the request path and POST the final verdict to callback_url"""
+    # Only requests that passed every browser check are deferred
+    decision = _decide_with_isp(data, await research_isp_with_llm(isp_key), False)
+    try:
+        response = await _CALLBACK_CLIENT.post(data.callback_url, json=decision)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning("Verdict callback to %.100s failed: %s", data.callback_url, e)
+
+# A declared response model lets FastAPI serialize straight to JSON bytes via pydantic-core
+@app.post("/ai-decision", response_model=DecisionResponse)
+async def ai_decision(data: AICheckRequest, background_tasks: BackgroundTasks):
+    logger.debug("Request received - UA: %.50s...", data.ua or "")
 
     # 0. Honeypot visited check (absolute priority)
     if getattr(data, "honeypotVisited", False):
-        return format_decision("bot", details, "Honeypot triggered by client")
+        return format_decision("bot", data, "Honeypot triggered by client")
 
     # 1. Immediate red flags check (highest priority after honeypot)
-    if any([data.isBotUserAgent, data.isScraperISP, 
-           data.isIPAbuser, data.isSuspiciousTraffic,
-           data.isDataCenterASN]):
-        return format_decision("bot", details)
+    if (data.isBotUserAgent or data.isScraperISP or
+            data.isIPAbuser or data.isSuspiciousTraffic or
+            data.isDataCenterASN):
+        return format_decision("bot", data)
     
-    # 2. ISP analysis through AI classification
-    isp_classification, isp_reason = research_isp_with_llm(data.isp)
-    
-    if isp_classification == "unsafe":
-        return format_decision("bot", details, isp_reason)
-    elif isp_classification == "verification":
-        return format_decision("captcha", details, isp_reason)
-    
-    # 3. Browser integrity checks
-    ua = (data.ua or "").lower()
-    bot_indicators = {
-        "bot", "curl", "python", "wget", "scrapy",
-        "headless", "phantom", "selenium", "spider"
-    }
+    # 2. Browser integrity checks (evaluated before any LLM call)
+    ua = data.ua or ""
     
     suspicious_browser = (
         not data.jsEnabled or 
         not data.supportsCookies or
-        len(data.ua or "") < 20 or
-        any(x in ua for x in bot_indicators) or
-        data.screenRes in {"0x0", "1x1"}
+        len(ua) < 20 or
+        _BOT_INDICATORS_RE.search(ua) is not None or
+        data.screenRes in _BAD_RES
     )
     
-    if suspicious_browser:
-        return format_decision("captcha", details)
+    # 3. ISP analysis: known networks locally, then cached AI classification
+    # Normalized once; reused for the cache, single-flight and the prompt
+    isp_key = _isp_cache_key(data.isp) if data.isp else ""
+    isp_result = None
+    if isp_key:
+        isp_result = classify_isp_locally(data.isp) or _cache_get(isp_key)
     
-    # 4. Verified safe user
-    return format_decision("user", details)
+    if suspicious_browser and isp_result is None:
+        # Already a captcha either way; classify the ISP off the request path
+        if isp_key:
+            background_tasks.add_task(research_isp_with_llm, isp_key)
+        return format_decision("captcha", data)
+    
+    # Without an ISP there is nothing to research; the browser checks decide
+    if isp_result is None and isp_key:
+        if _callback_allowed(data.callback_url):
+            # Answer now and post the ISP-informed verdict once research finishes
+            background_tasks.add_task(_resolve_isp_and_post, data, isp_key)
+            return format_decision("pending_isp", data)
+        isp_result = await research_isp_with_llm(isp_key)
+    return _decide_with_isp(data, isp_result, suspicious_browser)
 
+if __name__ == "__main__":
+    import uvicorn
+
+    # With uvicorn[standard] installed, uvloop and httptools are picked up automatically.
+    # Each worker is a separate process with its own client, cache and batcher.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "main:app" if workers > 1 else app,  # Multiple workers need an import string
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        # Verdicts are already logged by format_decision(); set UVICORN_ACCESS_LOG=1 for per-request lines
+        access_log=os.getenv("UVICORN_ACCESS_LOG", "0") == "1"
+    )